@@ -2020,11 +2020,11 @@ class Translator:
 
             # Mark entries that should be blocked as having a score of np.inf
             if self.global_avoid_trie or any(raw_avoid_list):
-                block_indices = avoid_states.avoid()
-                if len(block_indices) > 0:
-                    scores[block_indices] = np.inf
+                block_rows, block_cols = avoid_states.avoid()
+                if block_rows.size > 0:
+                    scores[block_rows, block_cols] = np.inf
                     if self.sample is not None:
-                        target_dists[block_indices] = np.inf
+                        target_dists[block_rows, block_cols] = np.inf
 
             # (3) Get beam_size winning hypotheses for each sentence block separately. Only look as
             # far as the active beam size for each sentence.
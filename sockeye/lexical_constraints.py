@@ -11,10 +11,9 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
-import copy
+import heapq
 import logging
-from operator import attrgetter
-from typing import Dict, List, Optional, Tuple, Set
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple, Set
 
 import mxnet as mx
 import numpy as np
@@ -30,10 +29,14 @@ class AvoidTrie:
     Represents a set of phrasal constraints for an input sentence.
     These are organized into a trie.
     """
+
+    __slots__ = ('final_ids', 'children', '_compiled')
+
     def __init__(self,
                  raw_phrases: Optional[RawConstraintList] = None) -> None:
         self.final_ids = set()  # type: Set[int]
         self.children = {}  # type: Dict[int,'AvoidTrie']
+        self._compiled = None  # type: Optional[CompiledAvoidTrie]
 
         if raw_phrases:
             for phrase in raw_phrases:
@@ -58,6 +61,7 @@ class AvoidTrie:
     def add_trie(self,
                  trie: 'AvoidTrie',
                  phrase: Optional[List[int]] = None) -> None:
+        self._compiled = None
         self.final_ids |= trie.final()
         for child_id, child in trie.children.items():
             if child_id not in self.children:
@@ -71,6 +75,7 @@ class AvoidTrie:
 
         :param phrase: A list of word IDs to add to this trie node.
         """
+        self._compiled = None
         if len(phrase) == 1:
             self.final_ids.add(phrase[0])
         else:
@@ -96,6 +101,131 @@ class AvoidTrie:
         """
         return self.final_ids
 
+    def compile(self) -> 'CompiledAvoidTrie':
+        """
+        Returns an array-backed copy of this trie. The copy is cached until the trie is modified.
+
+        :return: The compiled trie.
+        """
+        if self._compiled is None:
+            self._compiled = CompiledAvoidTrie([self])
+        return self._compiled
+
+
+class CompiledAvoidTrie:
+    """
+    A read-only, array-backed copy of one or more AvoidTries, used by AvoidBatch to advance the states of
+    all hypotheses at once. Trie nodes are numbered consecutively, and a state is simply a node number.
+
+    All arcs are stored in a single sorted array of keys (node * key_base + word_id), with a parallel array
+    of target nodes, so that the transitions for a whole batch are found with one np.searchsorted().
+    The final IDs of node n are final_ids[final_offsets[n]:final_offsets[n + 1]].
+
+    :param tries: The tries to compile. The root node of each is recorded in `roots`, in the same order.
+    """
+    def __init__(self, tries: List[AvoidTrie]) -> None:
+        nodes = []  # type: List[AvoidTrie]
+        node_root = []  # type: List[int]
+        arcs = []  # type: List[Tuple[int, int, int]]
+        roots = []  # type: List[int]
+        for trie in tries:
+            root = len(nodes)
+            roots.append(root)
+            nodes.append(trie)
+            node_root.append(root)
+            # Breadth-first walk, numbering the nodes of this trie as they are found
+            node = root
+            while node < len(nodes):
+                for word_id, child in nodes[node].children.items():
+                    arcs.append((node, word_id, len(nodes)))
+                    nodes.append(child)
+                    node_root.append(root)
+                node += 1
+
+        self.roots = np.array(roots, dtype='int32')
+        self.node_root = np.array(node_root, dtype='int32')
+
+        self.key_base = max((word_id for _, word_id, _ in arcs), default=0) + 1
+        arc_keys = np.array([node * self.key_base + word_id for node, word_id, _ in arcs], dtype='int64')
+        order = np.argsort(arc_keys)
+        self.arc_keys = arc_keys[order]
+        self.arc_targets = np.array([target for _, _, target in arcs], dtype='int32')[order]
+
+        finals = [sorted(node.final()) for node in nodes]
+        self.final_offsets = np.cumsum([0] + [len(final) for final in finals])
+        self.final_ids = np.array([word_id for final in finals for word_id in final], dtype='int32')
+
+    def __len__(self) -> int:
+        """
+        Returns the number of nodes in the compiled trie.
+        """
+        return len(self.node_root)
+
+    def step(self, states: np.ndarray, word_ids: np.ndarray) -> np.ndarray:
+        """
+        Returns the child node of each state along the arc of the corresponding word ID.
+
+        :param states: The node of each hypothesis.
+        :param word_ids: The word ID of each hypothesis.
+        :return: The child nodes, with -1 where no such arc exists.
+        """
+        next_states = np.full(states.shape, -1, dtype='int32')
+        if self.arc_keys.size == 0:
+            return next_states
+        keys = states.astype('int64') * self.key_base + word_ids
+        positions = np.minimum(np.searchsorted(self.arc_keys, keys), self.arc_keys.size - 1)
+        found = (self.arc_keys[positions] == keys) & (word_ids < self.key_base)
+        next_states[found] = self.arc_targets[positions[found]]
+        return next_states
+
+    def consume(self, states: np.ndarray, word_ids: np.ndarray) -> np.ndarray:
+        """
+        Consumes a word for each state. This follows the same cases as AvoidState.consume(): take the arc
+        from the current node if there is one, else the arc from the root, else reset to the root.
+
+        :param states: The node of each hypothesis.
+        :param word_ids: The word ID generated by each hypothesis.
+        :return: The new node of each hypothesis.
+        """
+        roots = self.node_root[states]
+        next_states = self.step(states, word_ids)
+        missing = next_states == -1
+        # States already at their root have just been looked up, so only retry from the root for the others
+        retry = missing & (states != roots)
+        if retry.any():
+            next_states[retry] = self.step(roots[retry], word_ids[retry])
+            missing = next_states == -1
+        next_states[missing] = roots[missing]
+        return next_states
+
+    def final(self, state: int) -> np.ndarray:
+        """
+        Returns the final ids at a node.
+
+        :param state: The node.
+        :return: The word IDs that end a constraint at this node.
+        """
+        return self.final_ids[self.final_offsets[state]:self.final_offsets[state + 1]]
+
+    def avoid(self, states: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the word IDs that should be avoided by each state: the final ids of its node and of its root.
+
+        :param states: The node of each hypothesis.
+        :return: Two parallel arrays: the position of the state in `states`, and a word ID to avoid.
+        """
+        positions = np.arange(states.shape[0], dtype='int32')
+        not_root = states != self.node_root[states]
+        nodes = np.concatenate((self.node_root[states], states[not_root]))
+        positions = np.concatenate((positions, positions[not_root]))
+
+        # Expand each node into the range of its final ids
+        starts = self.final_offsets[nodes]
+        counts = self.final_offsets[nodes + 1] - starts
+        ends = np.cumsum(counts)
+        offsets = np.arange(ends[-1] if ends.size else 0) + np.repeat(starts - ends + counts, counts)
+        return np.repeat(positions, counts), self.final_ids[offsets]
+
 
 class AvoidState:
     """
@@ -106,6 +236,9 @@ class AvoidState:
     :param avoid_trie: The trie containing the phrases to avoid.
     :param state: The current state (defaults to root).
     """
+
+    __slots__ = ('root', 'state')
+
     def __init__(self,
                  avoid_trie: AvoidTrie,
                  state: AvoidTrie = None) -> None:
@@ -128,11 +261,13 @@ class AvoidState:
 
         :param word_id: The word that was just generated.
         """
-        if word_id in self.state.children:
-            return AvoidState(self.root, self.state.step(word_id))
-        elif word_id in self.root.children:
-            return AvoidState(self.root, self.root.step(word_id))
-        elif self.state != self.root:
+        next_state = self.state.step(word_id)
+        if next_state is None and self.state is not self.root:
+            next_state = self.root.step(word_id)
+
+        if next_state is not None:
+            return AvoidState(self.root, next_state)
+        elif self.state is not self.root:
             return AvoidState(self.root, self.root)
         else:
             return self
@@ -153,7 +288,7 @@ class AvoidState:
 class AvoidBatch:
     """
     Represents a set of phrasal constraints for all items in the batch.
-    For each hypotheses, there is an AvoidTrie tracking its state.
+    For each hypotheses, there is a node in a CompiledAvoidTrie tracking its state.
 
     :param batch_size: The batch size.
     :param beam_size: The beam size.
@@ -166,30 +301,40 @@ class AvoidBatch:
                  avoid_list: Optional[List[RawConstraintList]] = None,
                  global_avoid_trie: Optional[AvoidTrie] = None) -> None:
 
-        self.global_avoid_states = []  # type: List[AvoidState]
-        self.local_avoid_states = []  # type: List[AvoidState]
+        self.global_avoid_trie = None  # type: Optional[CompiledAvoidTrie]
+        self.global_avoid_states = None  # type: Optional[np.ndarray]
+        self.local_avoid_trie = None  # type: Optional[CompiledAvoidTrie]
+        self.local_avoid_states = None  # type: Optional[np.ndarray]
 
-        # Store the global trie for each hypothesis
+        # Store the global trie for each hypothesis. A trie without phrases never blocks anything, so it is skipped.
         if global_avoid_trie is not None:
-            self.global_avoid_states = [AvoidState(global_avoid_trie)] * batch_size * beam_size
+            compiled_trie = global_avoid_trie.compile()
+            if compiled_trie.final_ids.size > 0:
+                self.global_avoid_trie = compiled_trie
+                self.global_avoid_states = np.repeat(compiled_trie.roots, batch_size * beam_size)
 
         # Store the sentence-level tries for each item in their portions of the beam
-        if avoid_list is not None:
-            for raw_phrases in avoid_list:
-                self.local_avoid_states += [AvoidState(AvoidTrie(raw_phrases))] * beam_size
+        if avoid_list is not None and any(avoid_list):
+            self.local_avoid_trie = CompiledAvoidTrie([AvoidTrie(raw_phrases) for raw_phrases in avoid_list])
+            self.local_avoid_states = np.repeat(self.local_avoid_trie.roots, beam_size)
 
     def reorder(self, indices: mx.nd.NDArray) -> None:
         """
         Reorders the avoid list according to the selected row indices.
-        This can produce duplicates, but this is fixed if state changes occur in consume().
+        This can produce duplicates, which is fine, since states are plain node numbers.
 
         :param indices: An mx.nd.NDArray containing indices of hypotheses to select.
         """
-        if self.global_avoid_states:
-            self.global_avoid_states = [self.global_avoid_states[x] for x in indices.asnumpy()]
+        if self.global_avoid_states is None and self.local_avoid_states is None:
+            return
+
+        indices = indices.asnumpy().astype(np.intp)
 
-        if self.local_avoid_states:
-            self.local_avoid_states = [self.local_avoid_states[x] for x in indices.asnumpy()]
+        if self.global_avoid_states is not None:
+            self.global_avoid_states = self.global_avoid_states[indices]
+
+        if self.local_avoid_states is not None:
+            self.local_avoid_states = self.local_avoid_states[indices]
 
     def consume(self, word_ids: mx.nd.NDArray) -> None:
         """
@@ -197,33 +342,40 @@ class AvoidBatch:
 
         :param word_ids: The set of word IDs.
         """
-        word_ids = word_ids.asnumpy().tolist()
-        for i, word_id in enumerate(word_ids):
-            if self.global_avoid_states:
-                self.global_avoid_states[i] = self.global_avoid_states[i].consume(word_id)
-            if self.local_avoid_states:
-                self.local_avoid_states[i] = self.local_avoid_states[i].consume(word_id)
+        if self.global_avoid_states is None and self.local_avoid_states is None:
+            return
+
+        word_ids = word_ids.asnumpy().astype('int64')
+        if self.global_avoid_states is not None:
+            self.global_avoid_states = self.global_avoid_trie.consume(self.global_avoid_states, word_ids)
+        if self.local_avoid_states is not None:
+            self.local_avoid_states = self.local_avoid_trie.consume(self.local_avoid_states, word_ids)
 
-    def avoid(self) -> Tuple[Tuple[int], Tuple[int]]:
+    def avoid(self) -> Tuple[np.ndarray, np.ndarray]:
         """
         Assembles a list of per-hypothesis words to avoid. The indices are (x, y) pairs into the scores
         array, which has dimensions (beam_size, target_vocab_size). These values are then used by the caller
         to set these items to np.inf so they won't be selected. Words to be avoided are selected by
         consulting both the global trie of phrases and the sentence-specific one.
 
-        :return: Two lists of indices: the x coordinates and y coordinates.
+        :return: Two arrays of indices: the x coordinates and y coordinates. These may contain duplicates.
         """
-        to_avoid = set()  # type: Set[Tuple[int, int]]
-        for i, state in enumerate(self.global_avoid_states):
-            for word_id in state.avoid():
-                if word_id > 0:
-                    to_avoid.add((i, word_id))
-        for i, state in enumerate(self.local_avoid_states):
-            for word_id in state.avoid():
-                if word_id > 0:
-                    to_avoid.add((i, word_id))
+        rows = [np.empty(0, dtype='int32')]  # type: List[np.ndarray]
+        cols = [np.empty(0, dtype='int32')]  # type: List[np.ndarray]
+        for trie, states in ((self.global_avoid_trie, self.global_avoid_states),
+                             (self.local_avoid_trie, self.local_avoid_states)):
+            if states is not None:
+                trie_rows, trie_cols = trie.avoid(states)
+                rows.append(trie_rows)
+                cols.append(trie_cols)
+
+        all_rows, all_cols = np.concatenate(rows), np.concatenate(cols)
+        valid = all_cols > 0
+        return all_rows[valid], all_cols[valid]
 
-        return tuple(zip(*to_avoid))  # type: ignore
+
+# The allowed() set of hypotheses that cannot be extended by any constraint
+_EMPTY_ALLOWED = frozenset()  # type: FrozenSet[int]
 
 
 class ConstrainedHypothesis:
@@ -251,6 +403,8 @@ class ConstrainedHypothesis:
     :param eos_id: The end-of-sentence ID.
     """
 
+    __slots__ = ('constraints', 'is_sequence', 'starts', 'eos_id', 'met', 'last_met', '_num_met', '_allowed')
+
     def __init__(self,
                  constraint_list: RawConstraintList,
                  eos_id: int) -> None:
@@ -265,11 +419,22 @@ class ConstrainedHypothesis:
             self.is_sequence += [True] * len(phrase)
             self.is_sequence[-1] = False
 
+        # `starts` maps each word ID to the positions at which it begins a constraint
+        #    (i.e., is not the middle of a phrase), so advance() need not scan all constraints.
+        self.starts = {}  # type: Dict[int, List[int]]
+        for pos, word_id in enumerate(self.constraints):
+            if pos == 0 or not self.is_sequence[pos - 1]:
+                self.starts.setdefault(word_id, []).append(pos)
+
         self.eos_id = eos_id
 
         # no constraints have been met
         self.met = [False for x in self.constraints]
         self.last_met = -1
+        # the number of True entries in `met`, kept up to date by advance()
+        self._num_met = 0
+        # the result of allowed(), computed on first use
+        self._allowed = None  # type: Optional[FrozenSet[int]]
 
     def __len__(self) -> int:
         """
@@ -295,38 +460,47 @@ class ConstrainedHypothesis:
         """
         :return: the number of constraints that have been met.
         """
-        return sum(self.met)
+        return self._num_met
 
     def num_needed(self) -> int:
         """
         :return: the number of un-met constraints.
         """
-        return self.size() - self.num_met()
+        return len(self.constraints) - self._num_met
 
-    def allowed(self) -> Set[int]:
+    def allowed(self) -> FrozenSet[int]:
         """
         Returns the set of constrained words that could follow this one.
         For unfinished phrasal constraints, it is the next word in the phrase.
         In other cases, it is the list of all unmet constraints.
         If all constraints are met, an empty set is returned.
+        The set is computed once, since a hypothesis does not change after advance() returns it.
 
-        :return: The ID of the next required word, or -1 if any word can follow
+        :return: The set of word IDs of constraints that could be generated next.
         """
-        items = set()  # type: Set[int]
+        if self._allowed is None:
+            self._allowed = self._compute_allowed()
+        return self._allowed
+
+    def _compute_allowed(self) -> FrozenSet[int]:
+        num_needed = self.num_needed()
+        if num_needed == 0:
+            return _EMPTY_ALLOWED
+
+        # EOS may only be generated once it is the last unmet constraint
+        eos_allowed = num_needed == 1
+
         # Add extensions of a started-but-incomplete sequential constraint
         if self.last_met != -1 and self.is_sequence[self.last_met] == 1:
             word_id = self.constraints[self.last_met + 1]
-            if word_id != self.eos_id or self.num_needed() == 1:
-                items.add(word_id)
+            if word_id != self.eos_id or eos_allowed:
+                return frozenset((word_id,))
+            return _EMPTY_ALLOWED
 
         # Add all constraints that aren't non-initial sequences
-        else:
-            for i, word_id in enumerate(self.constraints):
-                if not self.met[i] and (i == 0 or not self.is_sequence[i - 1]):
-                    if word_id != self.eos_id or self.num_needed() == 1:
-                        items.add(word_id)
-
-        return items
+        met = self.met
+        return frozenset(word_id for word_id, positions in self.starts.items()
+                         if (word_id != self.eos_id or eos_allowed) and not all(met[pos] for pos in positions))
 
     def finished(self) -> bool:
         """
@@ -343,7 +517,10 @@ class ConstrainedHypothesis:
         :param wordid: The wordid to validate.
         :return: True if all constraints are already met or the word ID is not the EOS id.
         """
-        return self.finished() or wordid != self.eos_id or (self.num_needed() == 1 and self.eos_id in self.allowed())
+        if wordid != self.eos_id:
+            return True
+        num_needed = len(self.constraints) - self._num_met
+        return num_needed == 0 or (num_needed == 1 and self.eos_id in self.allowed())
 
     def advance(self, word_id: int) -> 'ConstrainedHypothesis':
         """
@@ -355,40 +532,54 @@ class ConstrainedHypothesis:
         re-setting all of its words as unmet.
 
         :param word_id: The word ID to advance on.
-        :return: A deep copy of the object, advanced on word_id.
+        :return: A copy of the object, advanced on word_id, or the object itself if word_id changes nothing.
         """
 
-        obj = copy.deepcopy(self)
-
         # First, check if we're updating a sequential constraint.
-        if obj.last_met != -1 and obj.is_sequence[obj.last_met] == 1:
+        if self.last_met != -1 and self.is_sequence[self.last_met] == 1:
+            obj = self._copy()
             if word_id == obj.constraints[obj.last_met + 1]:
                 # Here, the word matches what we expect next in the constraint, so we update everything
                 obj.met[obj.last_met + 1] = True
                 obj.last_met += 1
+                obj._num_met += 1
             else:
                 # Here, the word is not the expected next word of the constraint, so we back out of the constraint.
                 index = obj.last_met
                 while obj.is_sequence[index]:
                     obj.met[index] = False
+                    obj._num_met -= 1
                     index -= 1
                 obj.last_met = -1
+            return obj
 
-        # If not, check whether we're meeting a single-word constraint
-        else:
-            # Build a list from all constraints of tuples of the
-            # form (constraint, whether it's a non-initial sequential, whether it's been met)
-            constraint_tuples = list(zip(obj.constraints, [False] + obj.is_sequence[:-1], obj.met))
-            # We are searching for an unmet constraint (word_id) that is not the middle of a phrase and is not met
-            query = (word_id, False, False)
-            try:
-                pos = constraint_tuples.index(query)
+        # If not, check whether we're meeting a single-word constraint.
+        # We are searching for an unmet constraint (word_id) that is not the middle of a phrase and is not met.
+        for pos in self.starts.get(word_id, ()):
+            if not self.met[pos]:
+                obj = self._copy()
                 obj.met[pos] = True
                 obj.last_met = pos
-            except ValueError:
-                # query not found; identical but duplicated object will be returned
-                pass
+                obj._num_met += 1
+                return obj
 
+        # Nothing was met. Hypotheses are never modified once returned, so this one can be shared.
+        return self
+
+    def _copy(self) -> 'ConstrainedHypothesis':
+        """
+        Returns a copy to be modified by advance(). The constraints never change after construction,
+        so copies share them (and their index) and only `met` is duplicated.
+        """
+        obj = ConstrainedHypothesis.__new__(ConstrainedHypothesis)
+        obj.constraints = self.constraints
+        obj.is_sequence = self.is_sequence
+        obj.starts = self.starts
+        obj.eos_id = self.eos_id
+        obj.met = self.met[:]
+        obj.last_met = self.last_met
+        obj._num_met = self._num_met
+        obj._allowed = None
         return obj
 
 
@@ -461,7 +652,7 @@ class ConstrainedCandidate:
     :param hypothesis: The ConstrainedHypothesis containing information about met constraints.
     """
 
-    __slots__ = ('row', 'col', 'score', 'hypothesis')
+    __slots__ = ('row', 'col', 'score', 'hypothesis', 'num_met')
 
     def __init__(self,
                  row: int,
@@ -472,15 +663,72 @@ class ConstrainedCandidate:
         self.col = col
         self.score = score
         self.hypothesis = hypothesis
+        # the bank of the candidate, recorded once since it is needed for every bank decision
+        self.num_met = hypothesis.num_met()
 
-    def __hash__(self):
-        return hash((self.row, self.col))
+    def __str__(self):
+        return '({}, {}, {}, {})'.format(self.row, self.col, self.score, self.num_met)
 
-    def __eq__(self, other):
-        return self.row == other.row and self.col == other.col
 
-    def __str__(self):
-        return '({}, {}, {}, {})'.format(self.row, self.col, self.score, self.hypothesis.num_met())
+# A candidate in a bank of _CandidateBanks: (-score, -insertion order, candidate)
+_CandidateEntry = Tuple[float, int, ConstrainedCandidate]
+
+
+class _CandidateBanks:
+    """
+    Collects the candidates of topk() into banks by the number of constraints they have met.
+    Each bank is a heap bounded to the beam size, since get_bank_sizes() never assigns more slots than that
+    to a single bank; worse candidates are dropped as soon as a bank is full.
+    The `positions` attribute is the set of (row, col) positions of all candidates added so far, including
+    dropped ones, so that each position is only added once.
+
+    :param num_constraints: The number of constraints.
+    :param beam_size: The beam size.
+    """
+
+    __slots__ = ('beam_size', 'banks', 'positions')
+
+    def __init__(self,
+                 num_constraints: int,
+                 beam_size: int) -> None:
+        self.beam_size = beam_size
+        # Heap entries are (-score, -insertion order, candidate), so the root of each heap is its worst candidate
+        self.banks = [[] for _ in range(num_constraints + 1)]  # type: List[List[_CandidateEntry]]
+        # The (row, col) positions of all candidates added so far
+        self.positions = set()  # type: Set[Tuple[int, int]]
+
+    def add(self, cand: ConstrainedCandidate) -> None:
+        """
+        Adds a candidate to its bank, evicting the worst one if the bank is full.
+
+        :param cand: The candidate. Its position must not have been added before.
+        """
+        self.positions.add((cand.row, cand.col))
+        entry = (-cand.score, -len(self.positions), cand)
+        bank = self.banks[cand.num_met]
+        if len(bank) < self.beam_size:
+            heapq.heappush(bank, entry)
+        else:
+            heapq.heappushpop(bank, entry)
+
+    def counts(self) -> List[int]:
+        """
+        :return: The number of candidates kept in each bank.
+        """
+        return [len(bank) for bank in self.banks]
+
+    def select(self, bank_sizes: List[int]) -> List[ConstrainedCandidate]:
+        """
+        Returns the best candidates of each bank, sorted by score. Ties are kept in the order they were added.
+
+        :param bank_sizes: The number of candidates to take from each bank.
+        :return: The selected candidates.
+        """
+        selected = []  # type: List[_CandidateEntry]
+        for bank, bank_size in zip(self.banks, bank_sizes):
+            selected += heapq.nlargest(bank_size, bank)
+        selected.sort(reverse=True)
+        return [cand for _, _, cand in selected]
 
 
 def topk(timestep: int,
@@ -510,38 +758,86 @@ def topk(timestep: int,
         the updated constrained hypotheses, and the updated set of inactive hypotheses.
     """
 
+    # The best next word for every row and its score, found in a single pass over the scores on the device
+    # for the whole batch; only these (batch_size * beam_size) winners are copied to the host
+    best_next_scores, best_next = mx.nd.topk(scores, axis=1, k=1, ret_typ='both', is_ascend=True, dtype='int32')
+    best_next_scores = best_next_scores.reshape((-1,)).asnumpy().tolist()
+    best_next = best_next.reshape((-1,)).asnumpy().tolist()
+    # The inactive flags and the incoming top-k items are likewise copied to the host once for the batch.
+    # Each sentence updates these copies, and they are written back to the device once at the end.
+    inactive_np = inactive.asnumpy()
+    best_ids_np = best_ids.asnumpy()
+    best_word_ids_np = best_word_ids.asnumpy()
+    seq_scores_np = seq_scores.asnumpy()
+
     for sentno in range(batch_size):
         rows = slice(sentno * beam_size, sentno * beam_size + beam_size)
         if hypotheses[rows.start] is not None and hypotheses[rows.start].size() > 0:
-            best_ids[rows], best_word_ids[rows], seq_scores[rows], \
-                hypotheses[rows], inactive[rows] = _sequential_topk(timestep,
-                                                                    beam_size,
-                                                                    inactive[rows],
-                                                                    scores[rows],
-                                                                    hypotheses[rows],
-                                                                    best_ids[rows] - rows.start,
-                                                                    best_word_ids[rows],
-                                                                    seq_scores[rows])
-
-            # offsetting since the returned smallest_k() indices were slice-relative
-            best_ids[rows] += rows.start
+            best_ids_np[rows], best_word_ids_np[rows], seq_scores_np[rows], \
+                hypotheses[rows], inactive_np[rows] = _sequential_topk(timestep,
+                                                                       beam_size,
+                                                                       rows.start,
+                                                                       inactive_np[rows],
+                                                                       scores[rows],
+                                                                       best_next[rows],
+                                                                       best_next_scores[rows],
+                                                                       hypotheses[rows],
+                                                                       best_ids_np[rows],
+                                                                       best_word_ids_np[rows],
+                                                                       seq_scores_np[rows])
         else:
             # If there are no constraints for this sentence in the batch, everything stays
             # the same, except we need to mark all hypotheses as active
-            inactive[rows] = 0
+            inactive_np[rows] = 0
+
+    inactive[:] = inactive_np
+    best_ids[:] = best_ids_np
+    best_word_ids[:] = best_word_ids_np
+    seq_scores[:] = seq_scores_np
 
     return best_ids, best_word_ids, seq_scores, hypotheses, inactive
 
 
+def _selects_incoming(rows: List[int],
+                       cols: List[int],
+                       scores: List[float],
+                       is_inactive: List[int],
+                       best_next: List[int],
+                       best_next_scores: List[float]) -> bool:
+    """
+    Checks whether _sequential_topk(), when all constraints of a sentence are met, would select the incoming
+    items unchanged. This holds if they are sorted by score and no active row has a best next word outside of them
+    that scores better than the worst of them (ties go to the incoming items, which are added first).
+    Items from a top-k over the scores satisfy this, but sampled items need not.
+
+    :param rows: The rows of the incoming items, within the sentence.
+    :param cols: The word IDs of the incoming items.
+    :param scores: The scores of the incoming items.
+    :param is_inactive: The inactive flag of each row.
+    :param best_next: The word ID with the best score in each row.
+    :param best_next_scores: The parallel scores of the `best_next` words.
+    :return: True if the incoming items would be selected unchanged.
+    """
+    if any(prev > score for prev, score in zip(scores, scores[1:])):
+        return False
+    worst = scores[-1]
+    incoming = set(zip(rows, cols))
+    return all(is_inactive[row] or score >= worst or (row, col) in incoming
+               for row, (col, score) in enumerate(zip(best_next, best_next_scores)))
+
+
 def _sequential_topk(timestep: int,
                      beam_size: int,
-                     inactive: mx.nd.NDArray,
+                     offset: int,
+                     inactive: np.ndarray,
                      scores: mx.nd.NDArray,
+                     best_next: List[int],
+                     best_next_scores: List[float],
                      hypotheses: List[ConstrainedHypothesis],
-                     best_ids: mx.nd.NDArray,
-                     best_word_ids: mx.nd.NDArray,
-                     sequence_scores: mx.nd.NDArray) -> Tuple[np.array, np.array, np.array,
-                                                              List[ConstrainedHypothesis], mx.nd.NDArray]:
+                     best_ids: np.ndarray,
+                     best_word_ids: np.ndarray,
+                     sequence_scores: np.ndarray) -> Tuple[np.array, np.array, np.array,
+                                                              List[ConstrainedHypothesis], np.ndarray]:
     """
     Builds a new topk list such that the beam contains hypotheses having completed different numbers of constraints.
     These items are built from three different types: (1) the best items across the whole
@@ -549,87 +845,119 @@ def _sequential_topk(timestep: int,
 
     :param timestep: The current decoder timestep.
     :param beam_size: The length of the beam for each segment.
-    :param inactive: Array listing inactive rows (shape: (beam_size,)).
+    :param offset: The row of the segment's first hypothesis in the batch.
+    :param inactive: Host array listing inactive rows (shape: (beam_size,)). It is updated in place.
     :param scores: The scores array (shape: (beam_size, target_vocab_size)).
+    :param best_next: The word ID with the best score in each row of `scores` (shape: (beam_size,)).
+    :param best_next_scores: The parallel scores of the `best_next` words (shape: (beam_size,)).
     :param hypotheses: The list of hypothesis objects.
-    :param best_ids: The current list of best hypotheses (shape: (beam_size,)).
+    :param best_ids: The current list of best hypotheses, as rows of the batch (shape: (beam_size,)).
     :param best_word_ids: The parallel list of best word IDs (shape: (beam_size,)).
     :param sequence_scores: (shape: (beam_size, 1)).
-    :return: A tuple containing the best hypothesis rows, the best hypothesis words, the scores,
+    :return: A tuple containing the best hypothesis rows (of the batch), the best hypothesis words, the scores,
         the updated constrained hypotheses, and the updated set of inactive hypotheses.
     """
 
     num_constraints = hypotheses[0].size()
+    # The inactive flags are read as Python scalars
+    is_inactive = inactive.tolist()
+
+    # Fast path: once every hypothesis has met all of its constraints, every word is valid and advancing
+    # leaves a hypothesis unchanged. All candidates then share the last bank, and if the incoming items are
+    # what selection would pick anyway, they are kept as they are. Only the hypotheses need to follow their rows.
+    if all(hyp.finished() for hyp in hypotheses):
+        incoming_rows = [row - offset for row in best_ids.tolist()]
+        if _selects_incoming(incoming_rows, best_word_ids.tolist(), sequence_scores.reshape(-1).tolist(),
+                             is_inactive, best_next, best_next_scores):
+            inactive[:] = 0
+            return best_ids, best_word_ids, sequence_scores, [hypotheses[row] for row in incoming_rows], inactive
+
+    # The candidates, streamed into bounded per-bank heaps. Each (row, col) position is only added once.
+    candidates = _CandidateBanks(num_constraints, beam_size)
+    # Bound locally for the loops below
+    add_candidate = candidates.add
+    added = candidates.positions  # type: Set[Tuple[int, int]]
+
+    # EOS is the only word that can be invalid, so validity is decided once per row
+    eos_id = hypotheses[0].eos_id
+    eos_valid = np.array([hyp.is_valid(eos_id) for hyp in hypotheses])
 
-    candidates = set()
     # (1) Add all of the top-k items (which were passed) in as long as they pass the constraints
-    for row, col, seq_score in zip(best_ids, best_word_ids, sequence_scores):
-        row = int(row.asscalar())
-        col = int(col.asscalar())
-        if hypotheses[row] is not None and hypotheses[row].is_valid(col):
-            seq_score = float(seq_score.asscalar())
-            new_item = hypotheses[row].advance(col)
-            cand = ConstrainedCandidate(row, col, seq_score, new_item)
-            candidates.add(cand)
+    rows = best_ids - offset
+    keep = (best_word_ids != eos_id) | eos_valid[rows]
+    for row, col, seq_score in zip(rows[keep].tolist(),
+                                   best_word_ids[keep].tolist(),
+                                   sequence_scores.reshape(-1)[keep].tolist()):
+        add_candidate(ConstrainedCandidate(row, col, seq_score, hypotheses[row].advance(col)))
 
     # For each hypothesis, we add (2) all the constraints that could follow it and
-    # (3) the best item (constrained or not) in that row
-    best_next = mx.nd.argmin(scores, axis=1)
+    # (3) the best item (constrained or not) in that row.
+    # The scores of (2) are collected in `pending` and fetched from the device with a single gather.
+    pending = []  # type: List[Tuple[int, int, ConstrainedHypothesis]]
+    is_eos_valid = eos_valid.tolist()
     for row in range(beam_size):
-        if inactive[row]:
+        if is_inactive[row]:
             continue
 
         hyp = hypotheses[row]
 
+        # (3) add the single-best item after this (if it's valid)
+        col = best_next[row]
+        if (row, col) not in added and (col != eos_id or is_eos_valid[row]):
+            add_candidate(ConstrainedCandidate(row, col, best_next_scores[row], hyp.advance(col)))
+
         # (2) add all the constraints that could extend this
-        nextones = hyp.allowed()
+        for col in hyp.allowed():
+            if (row, col) not in added:
+                pending.append((row, col, hyp.advance(col)))
 
-        # (3) add the single-best item after this (if it's valid)
-        col = int(best_next[row].asscalar())
-        if hyp.is_valid(col):
-            nextones.add(col)
-
-        # Now, create new candidates for each of these items
-        for col in nextones:
-            new_item = hyp.advance(col)
-            score = scores[row, col].asscalar()
-            cand = ConstrainedCandidate(row, col, score, new_item)
-            candidates.add(cand)
-
-    # Sort the candidates. After allocating the beam across the banks, we will pick the top items
-    # for each bank from this list
-    sorted_candidates = sorted(candidates, key=attrgetter('score'))
-
-    # The number of hypotheses in each bank
-    counts = [0 for _ in range(num_constraints + 1)]
-    for cand in sorted_candidates:
-        counts[cand.hypothesis.num_met()] += 1
+    if pending:
+        pending_rows, pending_cols, _ = zip(*pending)
+        indices = mx.nd.array([pending_rows, pending_cols], ctx=scores.context, dtype='int32')
+        pending_scores = mx.nd.gather_nd(scores, indices).asnumpy().tolist()
+        for (row, col, new_item), score in zip(pending, pending_scores):
+            add_candidate(ConstrainedCandidate(row, col, score, new_item))
 
     # Adjust allocated bank sizes if there are too few candidates in any of them
-    bank_sizes = get_bank_sizes(num_constraints, beam_size, counts)
+    bank_sizes = get_bank_sizes(num_constraints, beam_size, candidates.counts())
 
-    # Sort the candidates into the allocated banks
-    pruned_candidates = []  # type: List[ConstrainedCandidate]
-    for i, cand in enumerate(sorted_candidates):
-        bank = cand.hypothesis.num_met()
-
-        if bank_sizes[bank] > 0:
-            pruned_candidates.append(cand)
-            bank_sizes[bank] -= 1
+    # Pick the top items of each bank
+    pruned_candidates = candidates.select(bank_sizes)
 
     num_pruned_candidates = len(pruned_candidates)
 
+    # If no item passes the constraints, the incoming items are kept and the whole beam is marked inactive
+    if num_pruned_candidates == 0:
+        inactive[:] = 1
+        return best_ids, best_word_ids, sequence_scores, [hypotheses[row] for row in rows.tolist()], inactive
+
+    # Fill the results directly, in the dtypes of the device arrays they are copied into
+    # (int32 indices, float32 scores), without building intermediate lists
+    best_rows = np.empty(beam_size, dtype='int32')
+    best_cols = np.empty(beam_size, dtype='int32')
+    best_scores = np.empty(beam_size, dtype='float32')
+    best_rows[:num_pruned_candidates] = np.fromiter((x.row + offset for x in pruned_candidates),
+                                                    dtype='int32', count=num_pruned_candidates)
+    best_cols[:num_pruned_candidates] = np.fromiter((x.col for x in pruned_candidates),
+                                                    dtype='int32', count=num_pruned_candidates)
+    best_scores[:num_pruned_candidates] = np.fromiter((x.score for x in pruned_candidates),
+                                                      dtype='float32', count=num_pruned_candidates)
+    best_hypotheses = [x.hypothesis for x in pruned_candidates]
+
     inactive[:num_pruned_candidates] = 0
 
-    # Pad the beam so array assignment still works
+    # Pad the beam with copies of the last candidate so array assignment still works
     if num_pruned_candidates < beam_size:
         inactive[num_pruned_candidates:] = 1
-        pruned_candidates += [pruned_candidates[num_pruned_candidates - 1]] * (beam_size - num_pruned_candidates)
-
-    return (np.array([x.row for x in pruned_candidates]),
-            np.array([x.col for x in pruned_candidates]),
-            np.array([[x.score] for x in pruned_candidates]),
-            [x.hypothesis for x in pruned_candidates],
+        best_rows[num_pruned_candidates:] = best_rows[num_pruned_candidates - 1]
+        best_cols[num_pruned_candidates:] = best_cols[num_pruned_candidates - 1]
+        best_scores[num_pruned_candidates:] = best_scores[num_pruned_candidates - 1]
+        best_hypotheses += [best_hypotheses[-1]] * (beam_size - num_pruned_candidates)
+
+    return (best_rows,
+            best_cols,
+            best_scores.reshape((beam_size, 1)),
+            best_hypotheses,
             inactive)
 
 
@@ -668,27 +996,23 @@ def main(args):
     import sys
     import json
 
-    for line in sys.stdin:
-        line = line.rstrip()
+    # Constraints are either all positive or all negative
+    key = 'avoid' if args.avoid else 'constraints'
+    encode = json.JSONEncoder(ensure_ascii=False).encode
 
+    def convert(line: str) -> str:
         # Constraints are in fields 2+
-        source, *restrictions = line.split('\t')
-
-        obj = {'text': source}
-        constraints = []
-        avoid_list = []
-        for item in restrictions:
-            if args.avoid:
-                avoid_list.append(item)
-            else:
-                constraints.append(item)
+        source, *restrictions = line.rstrip().split('\t')
+
+        obj = {'text': source}  # type: Dict[str, Any]
+        if restrictions:
+            obj[key] = restrictions
 
-        if constraints:
-            obj['constraints'] = constraints
-        if avoid_list:
-            obj['avoid'] = avoid_list
+        return encode(obj) + '\n'
 
-        print(json.dumps(obj, ensure_ascii=False), flush=True)
+    # Output is left to the stream's buffering and flushed once at the end, instead of after every line
+    sys.stdout.writelines(convert(line) for line in sys.stdin)
+    sys.stdout.flush()
 
 
 if __name__ == '__main__':
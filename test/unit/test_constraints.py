@@ -12,7 +12,7 @@
 # permissions and limitations under the License.
 
 import json
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import mxnet as mx
 import numpy as np
@@ -21,7 +21,8 @@ from math import ceil
 
 from sockeye.data_io import get_tokens, tokens2ids, strids2ids
 from sockeye.vocab import build_vocab, reverse_vocab
-from sockeye.lexical_constraints import init_batch, get_bank_sizes, topk, ConstrainedHypothesis, AvoidBatch, AvoidState, AvoidTrie
+from sockeye.lexical_constraints import (init_batch, get_bank_sizes, topk, ConstrainedHypothesis, ConstrainedCandidate,
+                                         AvoidBatch, AvoidState, AvoidTrie, CompiledAvoidTrie, _CandidateBanks)
 from sockeye.inference import Translator
 
 BOS_ID = 2
@@ -69,6 +70,27 @@ def test_constraints_bank_allocation(num_constraints, beam_size, counts, expecte
     assert allocation == expected_allocation
 
 
+"""
+Candidates are kept in bounded banks and selected by score. Ties keep the order in which candidates were added,
+without ever comparing the candidates themselves.
+"""
+def test_constraints_candidate_banks():
+    hyp = ConstrainedHypothesis([[11]], EOS_ID)
+    met_hyp = hyp.advance(11)
+    banks = _CandidateBanks(1, 2)
+    banks.add(ConstrainedCandidate(0, 5, 1.0, hyp))
+    banks.add(ConstrainedCandidate(1, 5, 1.0, hyp))
+    banks.add(ConstrainedCandidate(2, 5, 0.5, hyp))
+    banks.add(ConstrainedCandidate(0, 11, 2.0, met_hyp))
+    # the first bank only keeps its two best candidates, but evicted positions are still remembered
+    assert banks.counts() == [2, 1]
+    assert (1, 5) in banks.positions
+    selected = banks.select([1, 1])
+    assert [(x.row, x.col) for x in selected] == [(2, 5), (0, 11)]
+    selected = banks.select([2, 0])
+    assert [(x.row, x.col) for x in selected] == [(2, 5), (0, 5)]
+
+
 """
 Make sure the internal representation is correct.
 For the internal representation, the list of phrasal constraints is concatenated, and then
@@ -108,6 +130,10 @@ Tests many of the ConstrainedHypothesis functions.
                              ([[11, 12, 13], [14], [15]], [11, 12, 13], [14, 15]),
                              # Same word twice
                              ([[11], [11]], [], [11, 11]),
+                             # Same word twice, one met
+                             ([[11], [11]], [11], [11]),
+                             # A word in the middle of a phrase does not meet it
+                             ([[11, 12], [13]], [12], [11, 12, 13]),
                              ])
 def test_constraints_logic(raw_constraints, met, unmet):
     hyp = ConstrainedHypothesis(raw_constraints, EOS_ID)
@@ -120,6 +146,25 @@ def test_constraints_logic(raw_constraints, met, unmet):
     assert hyp.is_valid(EOS_ID) == (hyp.finished() or (len(unmet) == 1 and EOS_ID in unmet))
 
 
+"""
+Advancing returns a new hypothesis and leaves the original one untouched.
+"""
+def test_constraints_advance_copies():
+    hyp = ConstrainedHypothesis([[11, 12], [13]], EOS_ID)
+    new_hyp = hyp.advance(11).advance(12)
+    assert new_hyp.num_met() == 2
+    assert hyp.num_met() == 0
+    assert hyp.allowed() == {11, 13}
+    assert new_hyp.constraints is hyp.constraints
+
+    # a word that meets no constraint returns the same, unchanged hypothesis
+    assert hyp.advance(99) is hyp
+
+    # backing out of an incomplete phrase resets the count of met constraints
+    backed_out_hyp = hyp.advance(11).advance(13)
+    assert backed_out_hyp.num_met() == sum(backed_out_hyp.met) == 0
+
+
 """
 Test the allowed() function, which returns the set of unmet constraints that can be generated.
 When inside a phrase, this is only the next word of the phrase. Otherwise, it is all unmet constraints.
@@ -192,6 +237,126 @@ def test_constraints_init_batch(raw_constraint_lists):
             assert constraint.num_met() == num_met
 
 
+"""
+Once every hypothesis of a sentence has met its constraints, topk() keeps the incoming top-k items
+and only reorders the hypotheses to follow their rows.
+"""
+def test_constraints_topk_finished():
+    beam_size = 3
+    vocab_size = 8
+    # the hypotheses of the first sentence have all met their constraint, those of the second have not
+    hypotheses = init_batch([[[5]], [[6]]], beam_size, BOS_ID, EOS_ID)
+    finished = [hyp.advance(5) for hyp in hypotheses[:beam_size]]
+    hypotheses[:beam_size] = finished
+    best_ids = mx.nd.array([1, 0, 1, 3, 3, 4], dtype='int32')
+    best_word_ids = mx.nd.array([1, 1, 2, 1, 2, 1], dtype='int32')
+    seq_scores = mx.nd.array([[1], [2], [3], [4], [5], [6]])
+    inactive = mx.nd.array([0, 0, 1, 0, 0, 0], dtype='int32')
+    scores = np.full((2 * beam_size, vocab_size), 10.)
+    scores[best_ids.asnumpy(), best_word_ids.asnumpy()] = seq_scores.asnumpy().ravel()
+    scores[2] = np.inf
+    scores = mx.nd.array(scores)
+
+    best_ids, best_word_ids, seq_scores, hypotheses, inactive = topk(2, 2, beam_size, inactive, scores, hypotheses,
+                                                                     best_ids, best_word_ids, seq_scores)
+
+    assert best_ids.asnumpy().tolist()[:beam_size] == [1, 0, 1]
+    assert best_word_ids.asnumpy().tolist()[:beam_size] == [1, 1, 2]
+    assert seq_scores.asnumpy().ravel().tolist()[:beam_size] == [1, 2, 3]
+    assert inactive.asnumpy().tolist()[:beam_size] == [0, 0, 0]
+    assert hypotheses[:beam_size] == [finished[1], finished[0], finished[1]]
+    # the second sentence can still meet its constraint
+    assert any(hyp.num_met() == 1 for hyp in hypotheses[beam_size:])
+
+
+"""
+The shortcut for sentences whose constraints are all met must select the same beam as the full candidate search,
+also when the incoming items are not a score-sorted top-k (e.g., when sampling).
+"""
+@pytest.mark.parametrize("items, row_best, expected_items",
+                         [
+                             # sorted top-k items: kept as they are
+                             ([(1, 1, 1.), (0, 1, 2.), (1, 2, 3.)], [(0, 1, 2.), (1, 1, 1.), (2, 4, 5.)],
+                              [(1, 1, 1.), (0, 1, 2.), (1, 2, 3.)]),
+                             # a row's best word ties with the worst item: the item wins
+                             ([(1, 1, 1.), (0, 1, 2.), (1, 2, 3.)], [(0, 1, 2.), (1, 1, 1.), (2, 4, 3.)],
+                              [(1, 1, 1.), (0, 1, 2.), (1, 2, 3.)]),
+                             # unsorted top-k items: sorted by score
+                             ([(1, 1, 2.), (0, 1, 1.), (2, 1, 3.)], [(0, 1, 1.), (1, 1, 2.), (2, 1, 3.)],
+                              [(0, 1, 1.), (1, 1, 2.), (2, 1, 3.)]),
+                             # sampled items worse than the rows' best words: replaced by them
+                             ([(0, 6, 7.), (1, 6, 8.), (2, 6, 9.)], [(0, 1, 1.), (1, 1, 2.), (2, 1, 3.)],
+                              [(0, 1, 1.), (1, 1, 2.), (2, 1, 3.)]),
+                         ])
+def test_constraints_topk_finished_matches_full_path(items, row_best, expected_items):
+    beam_size = 3
+    vocab_size = 8
+
+    def run_topk():
+        hypotheses = [hyp.advance(5) for hyp in init_batch([[[5]]], beam_size, BOS_ID, EOS_ID)]
+        # topk() updates the list of hypotheses in place
+        original_hypotheses = list(hypotheses)
+        scores = np.full((beam_size, vocab_size), 10.)
+        for row, col, score in items + row_best:
+            scores[row, col] = score
+        best_ids, best_word_ids, seq_scores, new_hypotheses, inactive = topk(
+            2, 1, beam_size, mx.nd.zeros((beam_size,), dtype='int32'), mx.nd.array(scores), hypotheses,
+            mx.nd.array([row for row, _, _ in items], dtype='int32'),
+            mx.nd.array([col for _, col, _ in items], dtype='int32'),
+            mx.nd.array([[score] for _, _, score in items]))
+        return (list(zip(best_ids.asnumpy().tolist(), best_word_ids.asnumpy().tolist(),
+                         seq_scores.asnumpy().ravel().tolist())),
+                inactive.asnumpy().tolist(),
+                [original_hypotheses.index(hyp) for hyp in new_hypotheses])
+
+    result = run_topk()
+    with patch('sockeye.lexical_constraints._selects_incoming', return_value=False):
+        full_result = run_topk()
+
+    assert result == full_result
+    assert result[0] == expected_items
+    assert result[1] == [0] * beam_size
+    assert result[2] == [row for row, _, _ in expected_items]
+
+
+"""
+Inactive rows are inf everywhere except for PAD, which keeps a finite score. A top-k item extending an inactive row
+with PAD is a candidate like any other. If no item passes the constraints, the incoming items are kept and the
+whole beam is marked inactive.
+"""
+@pytest.mark.parametrize("inactive, items, expected_items, expected_inactive",
+                         [
+                             # the PAD item of inactive row 2 is selected from the bank of hypotheses with no
+                             # constraints met, and the other two slots go to the constrained word 5
+                             ([0, 0, 1], [(2, 0, .5), (0, 1, 1.), (1, 1, 2.)],
+                              [(2, 0, .5), (0, 5, 10.), (1, 5, 10.)], [0, 0, 0]),
+                             # all rows are inactive, and EOS is not valid before the constraint is met
+                             ([1, 1, 1], [(0, EOS_ID, np.inf), (1, EOS_ID, np.inf), (2, EOS_ID, np.inf)],
+                              [(0, EOS_ID, np.inf), (1, EOS_ID, np.inf), (2, EOS_ID, np.inf)], [1, 1, 1]),
+                         ])
+def test_constraints_topk_inactive(inactive, items, expected_items, expected_inactive):
+    beam_size = 3
+    vocab_size = 8
+    hypotheses = init_batch([[[5]]], beam_size, BOS_ID, EOS_ID)
+    scores = np.full((beam_size, vocab_size), 10.)
+    for row, is_inactive in enumerate(inactive):
+        if is_inactive:
+            scores[row] = np.inf
+            scores[row, 0] = .5
+    for row, col, score in items:
+        scores[row, col] = score
+
+    best_ids, best_word_ids, seq_scores, _, new_inactive = topk(
+        2, 1, beam_size, mx.nd.array(inactive, dtype='int32'), mx.nd.array(scores), hypotheses,
+        mx.nd.array([row for row, _, _ in items], dtype='int32'),
+        mx.nd.array([col for _, col, _ in items], dtype='int32'),
+        mx.nd.array([[score] for _, _, score in items]))
+
+    assert list(zip(best_ids.asnumpy().tolist(), best_word_ids.asnumpy().tolist(),
+                    seq_scores.asnumpy().ravel().tolist())) == expected_items
+    assert new_inactive.asnumpy().tolist() == expected_inactive
+
+
 test_avoid_list_data = [ (["this", "that", "this bad phrase", "this bad phrase that is longer"]),
                          ([]),
                          (["a really bad phrase"]),
@@ -254,6 +419,30 @@ def test_avoid_list_state(raw_phrase_list):
             new_state = state.consume(oov_id)
             assert new_state != state
 
+
+"""
+Ensure that the compiled trie walks the same states as AvoidState.
+"""
+@pytest.mark.parametrize("raw_phrase_list", test_avoid_list_data)
+def test_avoid_list_compiled_trie(raw_phrase_list):
+    vocab = {}
+    raw_phrase_list = [[vocab.setdefault(word, len(vocab) + 1) for word in get_tokens(phrase)]
+                       for phrase in raw_phrase_list]
+    root_trie = AvoidTrie(raw_phrase_list)
+    compiled_trie = CompiledAvoidTrie([AvoidTrie(), root_trie])
+    assert compiled_trie.roots.tolist() == [0, 1]
+
+    # Walk every phrase, with an OOV word in between, through both representations
+    oov_id = 83284
+    words = [word for phrase in raw_phrase_list for word in phrase + [oov_id]]
+    state = AvoidState(root_trie)
+    compiled_state = compiled_trie.roots[1:]
+    for word in words:
+        state = state.consume(word)
+        compiled_state = compiled_trie.consume(compiled_state, np.array([word]))
+        assert set(compiled_trie.avoid(compiled_state)[1].tolist()) == state.avoid()
+
+
 """
 Ensure that managing states for a whole batch works correctly.
 
@@ -263,6 +452,8 @@ expect (a function of the vocab size) that should be blocked.
 """
 @pytest.mark.parametrize("global_raw_phrase_list, raw_phrase_list, batch_size, beam_size, prefix, expected_avoid", [
     (['5 6 7 8'], None, 1, 3, '17', []),
+    (['5 6 7 12'], [None, None], 2, 2, '5 6 7', [(0, 12), (1, 12), (2, 12), (3, 12)]),
+    ([], [None], 1, 2, '5 6 7', []),
     (['5 6 7 12'], None, 1, 4, '5 6 7', [(0, 12), (1, 12), (2, 12), (3, 12)]),
     (['5 6 7 8', '9'], None, 1, 2, '5 6 7', [(0, 8), (0, 9), (1, 8), (1, 9)]),
     (['5 6 7 8', '13'], [[[10]]], 1, 2, '5 6 7', [(0, 8), (0, 10), (0, 13), (1, 8), (1, 10), (1, 13)]),
@@ -285,3 +476,18 @@ def test_avoid_list_batch(global_raw_phrase_list, raw_phrase_list, batch_size, b
 
     avoid = [(x, y) for x, y in zip(*avoid_batch.avoid())]
     assert set(avoid) == set(expected_avoid)
+
+
+"""
+Ensure that reordering the batch moves each hypothesis' state along with it.
+"""
+def test_avoid_list_batch_reorder():
+    global_avoid_trie = AvoidTrie([[5, 6, 7]])
+    avoid_batch = AvoidBatch(1, 3, avoid_list=[[[8, 9]]], global_avoid_trie=global_avoid_trie)
+
+    avoid_batch.consume(mx.nd.array([5, 8, 17]))
+    avoid_batch.reorder(mx.nd.array([2, 0, 1], dtype='int32'))
+    avoid_batch.consume(mx.nd.array([6, 6, 6]))
+
+    avoid = [(x, y) for x, y in zip(*avoid_batch.avoid())]
+    assert set(avoid) == {(1, 7)}